@@ -6,21 +6,31 @@
 # ----------------------------------------------------------------
 
 import argparse
-import pandas as pd
-import geopandas as gpd
-import folium
-from folium.plugins import HeatMap
 from datetime import datetime, timedelta
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
-import unicodedata
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shelve
+import hashlib
+import inspect
+import json
 import os
-import git
+import tempfile
+import subprocess
+from pathlib import Path
 
 OCORRE_JSON = "ocorrencias_SP_chatbot_REAL_v5.json"
 UBS_GEOJSON = "ubs_SP_oficiais.geojson"
 DST_SHP      = "SIRGAS_SHP_distrito.shp"  # shapefile contendo todos os distritos de SP
+BAIRROS_CACHE = "districts_filtered_{chave}.parquet"  # recorte reprojetado; chave = hash dos TARGETS
+GEOCODE_CACHE = "geocode_cache"  # cache (shelve) de endereço -> (lat, lon)
+COLUNAS_USADAS = ["Latitude", "Longitude", "Data_interacao", "Doenca_suspeita", "Endereco"]
+HTML_OUT     = "index.html"
+MANIFEST_JSON = "index.manifest.json"  # hash dos dados que geraram o HTML_OUT atual
+TEMPLATE_CACHE = "template.html.cache"  # esqueleto do mapa renderizado pelo folium
+
+# ————— Parâmetros do mapa base —————
+MAPA_CENTRO  = [-23.572, -46.630]  # também usado quando não há coordenadas válidas
+MAPA_ZOOM    = 13
+MAPA_TILES   = "OpenStreetMap"
 
 # ————— Parâmetros do HeatMap —————
 gradient     = {
@@ -32,242 +42,489 @@ gradient     = {
 radius       = 35
 blur         = 18
 min_opacity  = 0.1   # conforme V17
+HEAT_GRID    = 0.0005  # célula (~55 m) usada para agregar os pontos do HeatMap
+
+# ————— Marcador das UBS (mesmo visual do folium.Icon verde “plus-sign”) —————
+UBS_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({
+        icon: 'plus-sign', prefix: 'glyphicon', markerColor: 'green', iconColor: 'white'
+    });
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindTooltip(row[2]);
+    return marker;
+};
+"""
+
+# ————— Camadas montadas no navegador a partir do JSON @@DADOS@@ —————
+# O esqueleto (tiles, JS/CSS dos plugins, tabela) é fixo entre execuções e
+# fica em cache; a cada execução só os dados são substituídos nos marcadores.
+CAMADAS_JS = """
+{% macro script(this, kwargs) %}
+    (function () {
+        var mapa = {{ this._parent.get_name() }};
+        var dados = @@DADOS@@;
+        var opcoesHeat = {{ this.opcoes_heat }};
+        var criarMarcadorUbs = {{ this.callback_ubs }}
+        var camadas = {};
+        mapa.setView(dados.centro, {{ this.zoom }});
+        dados.heat.forEach(function (camada) {
+            camadas[camada[0]] = L.heatLayer(camada[1], opcoesHeat).addTo(mapa);
+        });
+        if (dados.ubs.length) {
+            var ubs = L.markerClusterGroup();
+            dados.ubs.forEach(function (row) { ubs.addLayer(criarMarcadorUbs(row)); });
+            camadas["UBS"] = ubs.addTo(mapa);
+        }
+        L.control.layers(null, camadas).addTo(mapa);
+    })();
+{% endmacro %}
+"""
 
 #
 # ➤ 0️⃣: PARSE DOS ARGUMENTOS DE PERÍODO
 #
-parser = argparse.ArgumentParser(
-    description="Gera mapa de calor com filtro opcional de período (--inicio, --fim ou --ultimos_dias)."
-)
-parser.add_argument(
-    "--inicio",
-    help="Data de início do período (formato YYYY-MM-DD).",
-    required=False,
-    type=str,
-)
-parser.add_argument(
-    "--fim",
-    help="Data de término do período (formato YYYY-MM-DD).",
-    required=False,
-    type=str,
-)
-parser.add_argument(
-    "--ultimos_dias",
-    help="Últimos N dias (inteiro). Se informado, ignora --inicio/--fim.",
-    required=False,
-    type=int,
-)
-args = parser.parse_args()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Gera mapa de calor com filtro opcional de período (--inicio, --fim ou --ultimos_dias)."
+    )
+    parser.add_argument(
+        "--inicio",
+        help="Data de início do período (formato YYYY-MM-DD).",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--fim",
+        help="Data de término do período (formato YYYY-MM-DD).",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--ultimos_dias",
+        help="Últimos N dias (inteiro). Se informado, ignora --inicio/--fim.",
+        required=False,
+        type=int,
+    )
+    return parser.parse_args(argv)
 
 #
-# Função auxiliar para normalizar texto (remover acentos, converter para caixa alta)
+# Geocodifica um endereço, devolvendo (lat, lon) ou (None, None) em caso de falha
 #
-def normalize_str(s):
-    return (
-        unicodedata.normalize("NFKD", str(s))
-        .encode("ASCII", "ignore")
-        .decode("ASCII", "ignore")
-        .upper()
-    )
-
-# 1️⃣ LEITURA DOS DADOS DE OCORRÊNCIA
-df = pd.read_json(OCORRE_JSON)
-
-# ——————————————————————————————————————————
-# 1a️⃣ Geocodificação de registros sem Latitude/Longitude
-# ----------------------------------------------------------------
-if "Endereco" not in df.columns:
-    raise ValueError("Coluna 'Endereco' não encontrada no JSON de ocorrências.")
-
-geolocator = Nominatim(user_agent="aedesmap_geocoder")
-geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
-
-if "Latitude" not in df.columns:
-    df["Latitude"] = pd.NA
-if "Longitude" not in df.columns:
-    df["Longitude"] = pd.NA
-
-# Itera apenas sobre linhas sem coordenadas
-for idx, row in df[df["Latitude"].isna() | df["Longitude"].isna()].iterrows():
-    endereco = row["Endereco"]
-    if pd.isna(endereco) or endereco.strip() == "":
-        continue
+def geocode_endereco(geolocator, endereco):
     try:
-        loc = geocode(endereco)
+        loc = geolocator.geocode(endereco)
     except Exception:
         loc = None
-    if loc:
-        df.at[idx, "Latitude"] = loc.latitude
-        df.at[idx, "Longitude"] = loc.longitude
-    time.sleep(0.2)
-
-# 1b️⃣ Garantir Data_interacao como datetime
-if "Data_interacao" not in df.columns:
-    raise ValueError("Não encontrei a coluna 'Data_interacao' no JSON de ocorrências.")
-df["Data_interacao"] = pd.to_datetime(df["Data_interacao"])
-
-# 2️⃣ APLICAR FILTRO POR PERÍODO
-if args.ultimos_dias is not None:
-    hoje = datetime.today().date()
-    inicio_data = hoje - timedelta(days=args.ultimos_dias - 1)
-    df = df[df["Data_interacao"].dt.date >= inicio_data]
-else:
-    if args.inicio:
-        try:
-            dt_inicio = pd.to_datetime(args.inicio).normalize()
-        except:
-            raise ValueError("Parâmetro --inicio deve estar no formato YYYY-MM-DD.")
-        df = df[df["Data_interacao"] >= dt_inicio]
-    if args.fim:
-        try:
-            dt_fim = pd.to_datetime(args.fim).normalize() + timedelta(days=1)
-        except:
-            raise ValueError("Parâmetro --fim deve estar no formato YYYY-MM-DD.")
-        df = df[df["Data_interacao"] < dt_fim]
-
-# 3️⃣ LEITURA DAS UBS GEOJSON
-gdfU = gpd.read_file(UBS_GEOJSON)
-
-# 4️⃣ PREPARAÇÃO DO SHAPEFILE DE DISTRITOS (BAIRROS)
-gdf_dst_full = gpd.read_file(DST_SHP).set_crs(31983).to_crs(4326)
-
-# Normaliza o nome do distrito para remover acento
-gdf_dst_full["ds_nome_norm"] = gdf_dst_full["ds_nome"].apply(normalize_str)
-
-# Definir quais distritos queremos (removemos “ACLIMACAO” porque não existe como distrito)
-TARGETS = ["CAMBUCI", "LIBERDADE", "IPIRANGA"]
-
-# Filtrar apenas esses três (já normalizados)
-gdf_bairros = (
-    gdf_dst_full[gdf_dst_full["ds_nome_norm"].isin(TARGETS)]
-    .rename(columns={"ds_nome_norm": "bairro"})
-    .loc[:, ["bairro", "geometry"]]
-    .copy()
-)
-
-# 5️⃣ CRIA MAPA BASE
-map_center = [df["Latitude"].mean(), df["Longitude"].mean()] if not df.empty else [-23.572, -46.630]
-m = folium.Map(
-    location=map_center,
-    zoom_start=13,
-    tiles="OpenStreetMap"
-)
-
-# 6️⃣ HEATMAP POR DOENÇA
-for doenca, sub in df.groupby("Doenca_suspeita"):
-    pts = sub[["Latitude", "Longitude"]].values.tolist()
-    pts = [p + [1] for p in pts]
-    HeatMap(
-        pts,
-        name=f"{doenca} ({len(pts)})",
-        gradient=gradient,
-        radius=radius,
-        blur=blur,
-        min_opacity=0.1,
-    ).add_to(m)
-
-# 7️⃣ MARCADORES DE UBS PRÓXIMAS
-if not df.empty:
-    occ_pts = gpd.GeoSeries(
-        gpd.points_from_xy(df.Longitude, df.Latitude),
-        crs="EPSG:4326"
+    return (loc.latitude, loc.longitude) if loc else (None, None)
+
+#
+# Grava o arquivo via temporário + os.replace, para nunca deixar um HTML pela metade
+#
+def salvar_atomico(caminho, conteudo):
+    pasta = os.path.dirname(os.path.abspath(caminho))
+    fd, tmp = tempfile.mkstemp(dir=pasta, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(conteudo)
+        # mkstemp cria com 0600; aplica o modo que um open() comum daria
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, caminho)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+#
+# Chave do template: muda quando muda a versão do folium/branca/jinja2, um
+# parâmetro do mapa ou do HeatMap, o JS das camadas ou o próprio código
+# de renderizar_template()
+#
+def chave_template():
+    from importlib.metadata import version
+
+    partes = [
+        version("folium"), version("branca"), version("jinja2"),
+        MAPA_CENTRO, MAPA_ZOOM, MAPA_TILES,
+        gradient, radius, blur, min_opacity, UBS_MARKER_CALLBACK, CAMADAS_JS,
+        inspect.getsource(renderizar_template),
+    ]
+    return hashlib.sha256(json.dumps(partes, default=str).encode("utf-8")).hexdigest()
+
+#
+# Renderiza com o folium o esqueleto do mapa, com @@DADOS@@ e @@TABELA@@ no
+# lugar dos dados de cada execução
+#
+def renderizar_template():
+    import folium
+    from branca.element import Element, MacroElement
+    from folium.elements import JSCSSMixin
+    from folium.plugins import FastMarkerCluster, HeatMap
+    from jinja2 import Template
+
+    # JSCSSMixin injeta o JS/CSS dos plugins no header durante o render,
+    # depois do leaflet.js do próprio mapa
+    class CamadasAedesmap(JSCSSMixin, MacroElement):
+        _template = Template(CAMADAS_JS)
+        default_js = HeatMap.default_js + FastMarkerCluster.default_js
+        default_css = FastMarkerCluster.default_css
+
+    m = folium.Map(
+        location=MAPA_CENTRO,
+        zoom_start=MAPA_ZOOM,
+        tiles=MAPA_TILES
     )
-    buffer_area = occ_pts.unary_union.buffer(0.02)
-    gdfU_vis = gdfU[gdfU.within(buffer_area)]
-    for _, r in gdfU_vis.iterrows():
-        folium.Marker(
-            [r.lat, r.lon],
-            tooltip=r.nome,
-            icon=folium.Icon(color="green", icon="plus-sign")
-        ).add_to(m)
-else:
-    gdfU_vis = gpd.GeoDataFrame(columns=gdfU.columns)
 
-# ----------------------------------------------------------------
-# 8️⃣ CONTAGEM “OCORRÊNCIAS POR DISTRITO” VIA SPATIAL JOIN
-# ----------------------------------------------------------------
-tabela_contagens = {}
-if not df.empty:
-    # Primeiro, criamos GeoDataFrame com buffer minúsculo para minimizar erros de borda
-    gdf_occ = gpd.GeoDataFrame(
-        df,
-        geometry=gpd.points_from_xy(df.Longitude, df.Latitude),
-        crs="EPSG:4326"
+    camadas = CamadasAedesmap()
+    camadas.opcoes_heat = json.dumps({
+        "minOpacity": min_opacity,
+        "maxZoom": 18,
+        "radius": radius,
+        "blur": blur,
+        "gradient": {str(k): v for k, v in gradient.items()},
+    })
+    camadas.callback_ubs = UBS_MARKER_CALLBACK.strip()
+    camadas.zoom = MAPA_ZOOM
+    m.add_child(camadas)
+
+    m.get_root().html.add_child(Element("@@TABELA@@"))
+    return m.get_root().render()
+
+#
+# Devolve o esqueleto do cache em disco, renderizando-o só quando a chave muda
+#
+def carregar_template():
+    chave = chave_template()
+    cache_path = Path(TEMPLATE_CACHE)
+    if cache_path.exists():
+        cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        if cache.get("chave") == chave:
+            return cache["html"]
+    html = renderizar_template()
+    salvar_atomico(TEMPLATE_CACHE, json.dumps({"chave": chave, "html": html}))
+    return html
+
+def main(args):
+    # Imports pesados ficam aqui para que `--help` não pague o custo de
+    # carregar geopandas/pyproj/shapely (o folium só entra se o template mudar)
+    import numpy as np
+    import pandas as pd
+    import orjson
+    import geopandas as gpd
+    import shapely
+    from scipy.spatial import cKDTree
+
+    # 1️⃣ LEITURA DOS DADOS DE OCORRÊNCIA
+    df = pd.DataFrame.from_records(orjson.loads(Path(OCORRE_JSON).read_bytes()))
+    # Mantém só as colunas usadas no pipeline; as ausentes seguem para as
+    # verificações abaixo (que criam Latitude/Longitude ou acusam o erro)
+    df = df[[c for c in COLUNAS_USADAS if c in df.columns]].copy()
+
+    # ——————————————————————————————————————————
+    # 1a️⃣ Geocodificação de registros sem Latitude/Longitude
+    # ----------------------------------------------------------------
+    if "Endereco" not in df.columns:
+        raise ValueError("Coluna 'Endereco' não encontrada no JSON de ocorrências.")
+
+    # Geocodifica apenas endereços únicos, reaproveitando um cache em disco
+    # entre execuções e disparando as consultas restantes em paralelo
+    # (ArcGIS aceita requisições concorrentes, ao contrário do Nominatim).
+    if "Latitude" not in df.columns:
+        df["Latitude"] = pd.NA
+    if "Longitude" not in df.columns:
+        df["Longitude"] = pd.NA
+
+    addr_norm = df["Endereco"].fillna("").astype(str).str.strip()
+    sem_coord = df["Latitude"].isna() | df["Longitude"].isna()
+    missing = addr_norm[sem_coord].unique()
+
+    with shelve.open(GEOCODE_CACHE) as cache:
+        todo = [a for a in missing if a and a not in cache]
+        if todo:
+            from geopy.geocoders import ArcGIS
+
+            geolocator = ArcGIS(user_agent="aedesmap_geocoder", timeout=10)
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                futures = {ex.submit(geocode_endereco, geolocator, a): a for a in todo}
+                for fut in as_completed(futures):
+                    lat_lon = fut.result()
+                    # Só guardamos acertos, para que falhas sejam tentadas de novo
+                    if lat_lon[0] is not None:
+                        cache[futures[fut]] = lat_lon
+        resolvidos = {a: cache[a] for a in missing if a and a in cache}
+
+    df["Latitude"] = df["Latitude"].fillna(
+        addr_norm.map(lambda a: resolvidos.get(a, (None, None))[0])
     )
-    # Aplica um buffer de 0.0001° (~11m) para capturar pontos colados na borda
-    
-    joined = gpd.sjoin(
-        gdf_occ,
-        gdf_bairros,
-        how="left",
-        predicate="within",
+    df["Longitude"] = df["Longitude"].fillna(
+        addr_norm.map(lambda a: resolvidos.get(a, (None, None))[1])
     )
-    contagem_bairros = joined["bairro"].value_counts(dropna=False).to_dict()
-else:
-    contagem_bairros = {}
-
-# Garantir que aparece cada distrito, mesmo que zero
-for b in TARGETS:
-    tabela_contagens[b] = int(contagem_bairros.get(b, 0))
-
-# 9️⃣ CRIA O SNIPPET (HTML) FIXO COM A TABELA + LINHA TOTAL
-html_table = """
-<div style="
-    position: fixed;
-    bottom: 10px;
-    left: 10px;
-    z-index: 9999;
-    background-color: rgba(255, 255, 255, 0.8);
-    padding: 8px;
-    border: 1px solid #444;
-    font-size: 12px;
-">
-  <b>Ocorrências por Distrito</b>
-  <table style="border-collapse: collapse; margin-top: 4px;">
-    <tr>
-      <th style="padding: 2px 6px; border-bottom: 1px solid #666;">Distrito</th>
-      <th style="padding: 2px 6px; border-bottom: 1px solid #666;">Qtd.</th>
-    </tr>
-"""
-for b in TARGETS:
-    qtd = tabela_contagens[b]
-    html_table += f"""
-    <tr>
-      <td style="padding: 2px 6px; border-bottom: 1px solid #ddd;">{b}</td>
-      <td style="padding: 2px 6px; border-bottom: 1px solid #ddd; text-align: right;">{qtd}</td>
-    </tr>
+
+    # 1b️⃣ Garantir Data_interacao como datetime
+    if "Data_interacao" not in df.columns:
+        raise ValueError("Não encontrei a coluna 'Data_interacao' no JSON de ocorrências.")
+    datas_brutas = df["Data_interacao"]
+    if pd.api.types.is_numeric_dtype(datas_brutas):
+        # Epoch em ms (UTC): conversão direta int64 -> datetime64, sem parsing
+        datas = pd.to_datetime(datas_brutas, unit="ms", utc=True)
+    else:
+        # pandas >= 2 tem o caminho rápido "ISO8601", que aceita todas as
+        # variantes (frações de segundo, "Z", offsets); antes disso, inferimos
+        opcoes_data = {"format": "ISO8601"} if int(pd.__version__.split(".")[0]) >= 2 else {}
+        try:
+            datas = pd.to_datetime(datas_brutas, cache=True, errors="coerce", **opcoes_data)
+        except ValueError:
+            # Offsets diferentes entre linhas: normaliza tudo para UTC
+            datas = pd.to_datetime(
+                datas_brutas, cache=True, errors="coerce", utc=True, **opcoes_data
+            )
+    if getattr(datas.dt, "tz", None) is not None:
+        # Datas com fuso viram horário local de SP, sem fuso, como as demais
+        datas = datas.dt.tz_convert("America/Sao_Paulo").dt.tz_localize(None)
+
+    # Nunca publicar um mapa a partir de datas mal interpretadas
+    invalidas = datas.isna() & datas_brutas.notna()
+    if invalidas.any():
+        exemplos = ", ".join(map(repr, datas_brutas[invalidas].head(3)))
+        raise ValueError(
+            f"{int(invalidas.sum())} valor(es) de 'Data_interacao' não puderam ser "
+            f"interpretados como data (ex.: {exemplos})."
+        )
+    df["Data_interacao"] = datas
+
+    # 2️⃣ APLICAR FILTRO POR PERÍODO
+    # Acumula as condições numa única máscara e fatia o DataFrame uma vez só
+    mask = np.ones(len(df), dtype=bool)
+    if args.ultimos_dias is not None:
+        hoje = datetime.today().date()
+        # Compara como Timestamp (int64 vetorizado) em vez de .dt.date (objetos)
+        inicio_ts = pd.Timestamp(hoje - timedelta(days=args.ultimos_dias - 1))
+        mask &= (df["Data_interacao"] >= inicio_ts).to_numpy()
+    else:
+        if args.inicio:
+            try:
+                dt_inicio = pd.to_datetime(args.inicio).normalize()
+            except:
+                raise ValueError("Parâmetro --inicio deve estar no formato YYYY-MM-DD.")
+            mask &= (df["Data_interacao"] >= dt_inicio).to_numpy()
+        if args.fim:
+            try:
+                dt_fim = pd.to_datetime(args.fim).normalize() + timedelta(days=1)
+            except:
+                raise ValueError("Parâmetro --fim deve estar no formato YYYY-MM-DD.")
+            mask &= (df["Data_interacao"] < dt_fim).to_numpy()
+    if not mask.all():
+        df = df.loc[mask].reset_index(drop=True)
+
+    # 3️⃣ LEITURA DAS UBS GEOJSON
+    gdfU = gpd.read_file(UBS_GEOJSON)
+
+    # 4️⃣ PREPARAÇÃO DO SHAPEFILE DE DISTRITOS (BAIRROS)
+    # Definir quais distritos queremos (removemos “ACLIMACAO” porque não existe como distrito)
+    TARGETS = ["CAMBUCI", "LIBERDADE", "IPIRANGA"]
+
+    # O recorte reprojetado fica em cache (Parquet) enquanto o shapefile não
+    # mudar; o nome do arquivo inclui os TARGETS, então editar a lista invalida o cache
+    chave_targets = hashlib.sha256(json.dumps(TARGETS).encode("utf-8")).hexdigest()[:12]
+    bairros_cache = Path(BAIRROS_CACHE.format(chave=chave_targets))
+    # Os nomes (ds_nome) ficam no .dbf e o índice no .shx: qualquer um deles
+    # mais novo que o cache o invalida
+    mtime_shp = max(
+        os.path.getmtime(f)
+        for f in (DST_SHP, *(str(Path(DST_SHP).with_suffix(ext)) for ext in (".dbf", ".shx")))
+        if os.path.exists(f)
+    )
+    if bairros_cache.exists() and bairros_cache.stat().st_mtime >= mtime_shp:
+        gdf_bairros = gpd.read_parquet(bairros_cache)
+    else:
+        # pyogrio lê só a coluna de nome e empurra o filtro para o OGR, então
+        # apenas os polígonos dos TARGETS são lidos e reprojetados (no DBF os
+        # ds_nome já estão em caixa alta e sem acento, como no TARGETS)
+        filtro_sql = ", ".join(f"'{b}'" for b in TARGETS)
+        gdf_dst = gpd.read_file(
+            DST_SHP,
+            engine="pyogrio",
+            columns=["ds_nome"],
+            where=f"ds_nome IN ({filtro_sql})",
+        ).set_crs(31983).to_crs(4326)
+
+        # O WHERE já devolve só os TARGETS; resta expor o nome como "bairro"
+        gdf_bairros = (
+            gdf_dst.rename(columns={"ds_nome": "bairro"})
+            .loc[:, ["bairro", "geometry"]]
+        )
+        gdf_bairros.to_parquet(bairros_cache)
+
+    # 5️⃣ DADOS DO MAPA BASE
+    map_center = [df["Latitude"].mean(), df["Longitude"].mean()] if not df.empty else MAPA_CENTRO
+    # Sem nenhuma coordenada válida a média é NaN, e o Leaflet rejeitaria o
+    # setView (derrubando todas as camadas); usamos o centro padrão
+    if any(pd.isna(c) for c in map_center):
+        map_center = MAPA_CENTRO
+    # Tudo o que muda de uma execução para outra: vai para o @@DADOS@@ do
+    # template, e o hash disto decide se o HTML precisa ser gerado de novo
+    dados_mapa = {"centro": map_center, "heat": [], "ubs": [], "tabela": {}}
+
+    # 6️⃣ HEATMAP POR DOENÇA
+    # Agrega os pontos de cada doença numa grade de HEAT_GRID graus, somando
+    # o peso por célula: o Leaflet.heat recebe |células| pontos em vez de |ocorrências|
+    lat_arr = df["Latitude"].to_numpy(dtype=float)
+    lon_arr = df["Longitude"].to_numpy(dtype=float)
+    lat_bin = np.round(lat_arr / HEAT_GRID) * HEAT_GRID
+    lon_bin = np.round(lon_arr / HEAT_GRID) * HEAT_GRID
+    # sort=False evita ordenar a chave; as camadas seguem a ordem de aparição
+    grupos = df.groupby("Doenca_suspeita", sort=False, observed=True).indices
+    for doenca, idx in grupos.items():
+        agg = (
+            pd.DataFrame({"lat": lat_bin[idx], "lon": lon_bin[idx]})
+            .value_counts()
+            .reset_index(name="w")
+        )
+        pts = agg[["lat", "lon", "w"]].to_numpy(dtype=float).tolist()
+        dados_mapa["heat"].append([f"{doenca} ({len(idx)})", pts])
+
+    # 7️⃣ MARCADORES DE UBS PRÓXIMAS
+    if not df.empty:
+        # UBS a até 0.02° de alguma ocorrência: consulta de vizinho mais
+        # próximo numa KD-tree, em vez de unir/bufferizar todos os pontos
+        occ = np.c_[lon_arr, lat_arr]
+        occ = occ[~np.isnan(occ).any(axis=1)]
+        ubs = np.c_[gdfU["lon"].to_numpy(dtype=float), gdfU["lat"].to_numpy(dtype=float)]
+        if len(occ):
+            dists, _ = cKDTree(occ).query(ubs, k=1, distance_upper_bound=0.02)
+        else:
+            dists = np.full(len(gdfU), np.inf)
+        gdfU_vis = gdfU[dists <= 0.02]
+        # Um único array JSON + callback JS, em vez de um L.marker por UBS no HTML
+        dados_mapa["ubs"] = gdfU_vis[["lat", "lon", "nome"]].values.tolist()
+
+    # ----------------------------------------------------------------
+    # 8️⃣ CONTAGEM “OCORRÊNCIAS POR DISTRITO” VIA PONTO-EM-POLÍGONO
+    # ----------------------------------------------------------------
+    tabela_contagens = {}
+    if not df.empty:
+        # Um contains_xy vetorizado por distrito; os predicados do Shapely 2
+        # liberam o GIL, então os polígonos são contados em paralelo.
+        # Pontos exatamente sobre a divisa não contam (mesma regra do antigo
+        # sjoin com predicate="within"), sem precisar de buffer nos pontos
+        def contar_no_distrito(geom):
+            return int(shapely.contains_xy(geom, lon_arr, lat_arr).sum())
+
+        # Prepara (indexa as arestas de) cada polígono uma única vez, antes
+        # das threads, para que todos os contains_xy usem o índice do GEOS
+        geoms = np.asarray(gdf_bairros.geometry.values, dtype=object)
+        shapely.prepare(geoms)
+        with ThreadPoolExecutor(max_workers=len(geoms) or 1) as ex:
+            contagens = list(ex.map(contar_no_distrito, geoms))
+        contagem_bairros = dict(zip(gdf_bairros["bairro"].values, contagens))
+    else:
+        contagem_bairros = {}
+
+    # Garantir que aparece cada distrito, mesmo que zero
+    for b in TARGETS:
+        tabela_contagens[b] = int(contagem_bairros.get(b, 0))
+    dados_mapa["tabela"] = tabela_contagens
+
+    # 9️⃣ CRIA O SNIPPET (HTML) FIXO COM A TABELA + LINHA TOTAL
+    linhas_tabela = "".join(
+        f"""
+        <tr>
+          <td style="padding: 2px 6px; border-bottom: 1px solid #ddd;">{b}</td>
+          <td style="padding: 2px 6px; border-bottom: 1px solid #ddd; text-align: right;">{tabela_contagens[b]}</td>
+        </tr>
+        """
+        for b in TARGETS
+    )
+
+    # Linha “Total” no final
+    total_geral = sum(tabela_contagens.values())
+
+    html_table = f"""
+    <div style="
+        position: fixed;
+        bottom: 10px;
+        left: 10px;
+        z-index: 9999;
+        background-color: rgba(255, 255, 255, 0.8);
+        padding: 8px;
+        border: 1px solid #444;
+        font-size: 12px;
+    ">
+      <b>Ocorrências por Distrito</b>
+      <table style="border-collapse: collapse; margin-top: 4px;">
+        <tr>
+          <th style="padding: 2px 6px; border-bottom: 1px solid #666;">Distrito</th>
+          <th style="padding: 2px 6px; border-bottom: 1px solid #666;">Qtd.</th>
+        </tr>
+    {linhas_tabela}
+        <tr>
+          <td style="padding: 2px 6px; border-top: 2px solid #666;"><b>Total</b></td>
+          <td style="padding: 2px 6px; border-top: 2px solid #666; text-align: right;"><b>{total_geral}</b></td>
+        </tr>
+      </table>
+    </div>
     """
 
-# Linha “Total” no final
-total_geral = sum(tabela_contagens.values())
-html_table += f"""
-    <tr>
-      <td style="padding: 2px 6px; border-top: 2px solid #666;"><b>Total</b></td>
-      <td style="padding: 2px 6px; border-top: 2px solid #666; text-align: right;"><b>{total_geral}</b></td>
-    </tr>
-"""
-html_table += """
-  </table>
-</div>
-"""
+    # 🔟 LayerControl e salvamento
+    # Se dados, tabela e template são os mesmos da última geração, o HTML
+    # existente já está correto: pulamos a renderização do template e o commit
+    assinatura = hashlib.sha256(
+        json.dumps(
+            [chave_template(), html_table, dados_mapa], sort_keys=True, default=str
+        ).encode("utf-8")
+    ).hexdigest()
+    manifest_path = Path(MANIFEST_JSON)
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    html_path = Path(HTML_OUT)
+    # O index.html é versionado: um checkout/pull pode trocá-lo, então o
+    # arquivo em disco também precisa bater com o que foi gravado
+    html_em_disco = (
+        hashlib.sha256(html_path.read_bytes()).hexdigest() if html_path.exists() else None
+    )
+    if manifest.get("hash") == assinatura and manifest.get("hash_html") == html_em_disco:
+        print(f"✔  {HTML_OUT} já está atualizado — nada a fazer.")
+        return
+
+    # "</" escapado para que nenhum nome feche o <script> antes da hora
+    dados_js = json.dumps(dados_mapa, ensure_ascii=False).replace("</", "<\\/")
+    html = (
+        carregar_template()
+        .replace("@@DADOS@@", dados_js)
+        .replace("@@TABELA@@", html_table)
+    )
+    salvar_atomico(HTML_OUT, html)
+    print(f"✔  {HTML_OUT} pronto — abra no navegador.")
+
+    # ------------------------------------------------
+    # 11 - COMMIT AUTOMÁTICO NO GIT PARA VERCEL
+    # ------------------------------------------------
+    repo_path = "D:/DOCUMENTOS/GITHUB/AEDESMAP"
+    html_file = HTML_OUT
+
+    subprocess.run(["git", "-C", repo_path, "add", html_file], check=True)
+    # `git commit` falha sem nada staged (HTML idêntico ao do último commit)
+    sem_mudancas = subprocess.run(["git", "-C", repo_path, "diff", "--cached", "--quiet"]).returncode == 0
+    if sem_mudancas:
+        print("HTML sem alterações — nada para commitar.")
+    else:
+        subprocess.run(["git", "-C", repo_path, "commit", "-m", "Atualizando mapa de calor"], check=True)
+    # O push roda mesmo sem commit novo, para publicar um commit cujo push
+    # tenha falhado numa execução anterior
+    subprocess.run(["git", "-C", repo_path, "push", "origin"], check=True)
+    print("HTML atualizado no GitHub!")
+
+    # O manifest só é gravado depois do push: se algo acima falhar, a
+    # próxima execução com os mesmos dados tenta de novo em vez de pular
+    salvar_atomico(
+        MANIFEST_JSON,
+        json.dumps({
+            "hash": assinatura,
+            "arquivo": HTML_OUT,
+            "hash_html": hashlib.sha256(html.encode("utf-8")).hexdigest(),
+        }),
+    )
+
 
-from folium import Element
-m.get_root().html.add_child(Element(html_table))
-
-# 🔟 LayerControl e salvamento
-folium.LayerControl().add_to(m)
-m.save("index.html")
-print("✔  index.html pronto — abra no navegador.")
-
-# ------------------------------------------------
-# 11 - COMMIT AUTOMÁTICO NO GIT PARA VERCEL
-# ------------------------------------------------
-repo_path = "D:/DOCUMENTOS/GITHUB/AEDESMAP"
-html_file = "index.html"
-
-repo = git.Repo(repo_path)
-repo.index.add([html_file])
-repo.index.commit("Atualizando mapa de calor")
-origin = repo.remote(name="origin")
-origin.push()
-print("HTML atualizado no GitHub!")
\ No newline at end of file
+if __name__ == "__main__":
+    main(parse_args())